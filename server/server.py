@@ -17,7 +17,8 @@ app = Flask(__name__)
 
 def load_model():
     global model  # bc YOLO
-    model = tf.keras.experimental.load_from_saved_model(MODEL_DIR, custom_objects={'clippy': Clippy(clipped_relu)})
+    # The server only predicts, so the custom training metrics are not needed for compiling
+    model = tf.keras.models.load_model(MODEL_DIR, custom_objects={'clippy': Clippy(clipped_relu)}, compile=False)
 
 
 def make_prediction(cycle_data, response):
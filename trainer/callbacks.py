@@ -1,5 +1,10 @@
+import concurrent.futures
+import multiprocessing
+import shutil
+import tempfile
+import threading
+
 import tensorflow as tf
-from google.cloud import storage
 import numpy as np
 import trainer.evaluation as ev
 import os
@@ -8,6 +13,39 @@ from trainer import constants as cst
 from trainer import data_pipeline as dp
 
 
+def _get_predict_function(model):
+    """Wraps the forward pass of the model in a tf.function with a fixed input signature.
+
+    The function is traced once on the first call and reused for every following batch
+    and checkpoint. The inputs are passed as a list in the order of model.input_names,
+    because a dict is flattened by sorted keys and would be matched to the wrong inputs.
+    Features that are not inputs of the model are dropped before the call.
+    """
+    input_signature = [[tf.TensorSpec(shape=model_input.shape, dtype=model_input.dtype, name=name)
+                        for name, model_input in zip(model.input_names, model.inputs)]]
+    predict = tf.function(lambda inputs: model(inputs, training=False), input_signature=input_signature)
+    
+    def predict_fn(features):
+        return predict([features[name] for name in model.input_names])
+    return predict_fn
+
+
+def _upload_directory(local_dir, gcs_dir, pool):
+    """Uploads all files in local_dir to gcs_dir (gs://<bucket>/<prefix>) with the given thread pool.
+
+    Returns the futures of the single file uploads.
+    """
+    bucket_name, _, blob_prefix = gcs_dir[len("gs://"):].partition("/")
+    bucket = ev.get_bucket(bucket_name)
+    futures = []
+    for root, _, files in os.walk(local_dir):
+        for file in files:
+            local_path = os.path.join(root, file)
+            blob_name = "/".join([blob_prefix.rstrip("/")] + os.path.relpath(local_path, local_dir).split(os.sep))
+            futures.append(pool.submit(bucket.blob(blob_name.lstrip("/")).upload_from_filename, local_path))
+    return futures
+
+
 class CustomCheckpoints(tf.keras.callbacks.Callback):
     """
     Custom callback function with ability to save the model to GCP.
@@ -16,7 +54,10 @@ class CustomCheckpoints(tf.keras.callbacks.Callback):
     1) a checkpoint containing the model weights. (variables/)
     2) a SavedModel proto containing the Tensorflow backend 
     graph. (saved_model.pb)
-    3) the model's json config. (assets/)
+    3) the model's config and training config. (keras_metadata.pb or saved_model.pb, depending
+    on the TensorFlow version)
+    
+    Load it with tf.keras.models.load_model().
 
     For big models too many checkpoints can blow up the size of the
     log directory. To reduce the number of checkpoints, use the
@@ -27,7 +68,7 @@ class CustomCheckpoints(tf.keras.callbacks.Callback):
     
     dataset_path: data that is used for plotting the validation results.
     
-    dataset_config: Same config file that is used for creating the training and
+    dataset_config: Same DatasetConfig that is used for creating the training and
         validation datasets in train_and_evaluate(). This is needed to make the
         validation plot compareable.
     
@@ -37,77 +78,176 @@ class CustomCheckpoints(tf.keras.callbacks.Callback):
     than all previously saved models.
     
     period: Save model only for every n-th epoch.
+    
+    metrics: The metrics the model was compiled with. The exported copy of the
+    model is compiled with the same loss, optimizer configuration and metrics, so
+    the SavedModels contain the training config. The optimizer state (e.g. Adam
+    moments) is not copied.
+    
+    plot_samples: Number of validation samples used for the evaluation plot.
+    The samples are spread evenly over all cells of the validation set, the full
+    set is still evaluated by Keras. Set to None to plot the whole validation set.
+
+    max_to_keep: Number of weight checkpoints that are kept, older ones are deleted.
+    Set to None to keep the weights of every saved epoch.
+
+    During training only the weights are written with a tf.train.CheckpointManager
+    (to "checkpoints/weights"). SavedModels are exported once at the end of training,
+    for the last epoch and with save_best_only also for the best epoch into its
+    checkpoint directory. Without save_best_only the "epoch_*" directories only hold
+    the validation plots and the weights of saves older than the last max_to_keep
+    are discarded. A run that stops before on_train_end (e.g. a preempted job) leaves
+    no SavedModel, only the weight checkpoints, which can be restored into a model
+    built with the same configuration via tf.train.Checkpoint(model=model).restore().
+
+    Saving the weights and plotting the validation results run in a
+    background thread, so the next epoch can start right away. The weights
+    are copied at the end of the epoch and written from a clone of the model.
+    The validation plots are rendered and saved in a separate process.
     """
     def __init__(self, log_dir, dataset_path, dataset_config, start_epoch=0, 
-                 save_best_only=False, save_last_only=False, save_eval_plot=True, period=1):
+                 save_best_only=False, save_last_only=False, save_eval_plot=True, period=1, metrics=None,
+                 plot_samples=512, max_to_keep=3):
         self.log_dir = log_dir
         self.start_epoch = start_epoch
         self.save_best_only = save_best_only
         self.save_last_only = save_last_only
         self.save_eval_plot = save_eval_plot
         self.period = period
+        self.metrics = metrics
+        self.max_to_keep = max_to_keep
         self.cloud_run = cst.BUCKET_NAME in log_dir
-        if self.cloud_run:
-            self.client = storage.Client()
-            self.bucket = self.client.get_bucket(cst.BUCKET_NAME)  # Only used for saving evaluation plots
         if self.save_eval_plot:
-            self.validation_dataset = dp.create_dataset(data_dir=dataset_path,
-                                                        window_size=dataset_config["window_size"],
-                                                        shift=dataset_config["shift"],
-                                                        stride=dataset_config["stride"],
-                                                        batch_size=dataset_config["batch_size"],
-                                                        cycle_length=1,  # Has to be set for plotting
-                                                        num_parallel_calls=1,  # Has to be set for plotting
-                                                        shuffle=False,  # Has to be set for plotting
-                                                        repeat=False)  # Has to be set for plotting
+            # Data and order never change between plots
+            self.validation_dataset = dp.create_plot_dataset(data_dir=dataset_path,
+                                                             window_size=dataset_config.window_size,
+                                                             shift=dataset_config.shift,
+                                                             stride=dataset_config.stride,
+                                                             batch_size=dataset_config.batch_size,
+                                                             num_samples=plot_samples).cache()
+        self._io_lock = threading.Lock()  # Guards the export model against concurrent saves
+        self._max_pending_saves = 2  # Block training if the background thread falls behind
+        # Exports to GCS are written to local disk first and uploaded in parallel afterwards
+        self._stage_locally = log_dir.startswith("gs://")
     
     def on_train_begin(self, logs=None):
         self.last_saved_epoch = None
         self.lowest_loss = np.Inf
+        self._io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._pending = []
+        if self._stage_locally:
+            self._upload_pool = concurrent.futures.ThreadPoolExecutor(max_workers=8)
+        # Clone once, the background thread only swaps in the weights of the epoch to save
+        self._export_model = tf.keras.models.clone_model(self.model)
+        # clone_model() returns an uncompiled model, compile it like the original for complete SavedModels
+        self._export_model.compile(loss=self.model.loss,
+                                   optimizer=self.model.optimizer.from_config(self.model.optimizer.get_config()),
+                                   metrics=self.metrics)
+        self._predict_fn = _get_predict_function(self._export_model)
+        self._checkpoint = tf.train.Checkpoint(model=self._export_model)
+        self._checkpoint_manager = tf.train.CheckpointManager(self._checkpoint,
+                                                              os.path.join(self.log_dir, "checkpoints", "weights"),
+                                                              max_to_keep=self.max_to_keep)
+        if self.save_eval_plot:
+            # Spawn instead of fork, forking a process with a running TensorFlow runtime is unsafe
+            context = multiprocessing.get_context('spawn')
+            self._plot_queue = context.Queue()
+            self._plot_process = context.Process(target=ev.plot_worker, args=(self._plot_queue, self.cloud_run),
+                                                 daemon=True)
+            self._plot_process.start()
         
     def on_epoch_end(self, epoch, logs=None):
         self.current_loss = logs.get('val_loss')
-        if (epoch % self.period == 0) and (epoch >= self.start_epoch) and not self.save_last_only:
-            self.checkpoint_dir = os.path.join(self.log_dir,
-                                               "checkpoints", "epoch_{}_loss_{}".format(epoch, self.current_loss))
-            if self.save_best_only:
-                if self.current_loss < self.lowest_loss:
-                    tf.keras.experimental.export_saved_model(self.model, self.checkpoint_dir)
-                    if self.save_eval_plot:
-                        self._save_evaluation_plot(self.model, self.checkpoint_dir, self.validation_dataset)
-                    self.lowest_loss = self.current_loss
-                    self.last_saved_epoch = epoch
-            else:
-                tf.keras.experimental.export_saved_model(self.model, self.checkpoint_dir)
-                if self.save_eval_plot:
-                    self._save_evaluation_plot(self.model, self.checkpoint_dir, self.validation_dataset)
+        if (epoch % self.period != 0) or (epoch < self.start_epoch) or self.save_last_only:
+            return
+        if self.save_best_only and not self.current_loss < self.lowest_loss:
+            return  # Don't pay for an export if the model did not improve
+        
+        self.checkpoint_dir = os.path.join(self.log_dir,
+                                           "checkpoints", "epoch_{}_loss_{}".format(epoch, self.current_loss))
+        self._save_checkpoint_async(self.checkpoint_dir, export=False)
+        self.last_saved_epoch = epoch
+        if self.save_best_only:
+            self.lowest_loss = self.current_loss
 
     def on_train_end(self, logs=None):
         last_epoch_dir = os.path.join(self.log_dir, "checkpoints", "last_epoch_loss_{}".format(self.current_loss))
-        tf.keras.experimental.export_saved_model(self.model, last_epoch_dir)
+        self._save_checkpoint_async(last_epoch_dir, export=True)
+        if self.save_best_only and self.last_saved_epoch is not None:
+            # The best epoch is always the latest checkpoint, because only improvements are saved
+            self._pending.append(self._io_pool.submit(self._export_best_checkpoint, self.checkpoint_dir))
+        # Wait for all outstanding saves and raise errors that occurred in the background
+        for future in concurrent.futures.as_completed(self._pending):
+            future.result()
+        self._io_pool.shutdown(wait=True)
+        if self._stage_locally:
+            self._upload_pool.shutdown(wait=True)
         if self.save_eval_plot:
-            self._save_evaluation_plot(self.model, last_epoch_dir, self.validation_dataset)
+            self._plot_queue.put(None)
+            self._plot_process.join()
+            if self._plot_process.exitcode != 0:
+                raise RuntimeError("Saving validation plots failed with exit code {}"
+                                   .format(self._plot_process.exitcode))
+    
+    def _save_checkpoint_async(self, checkpoint_dir, export):
+        """Copies the current weights and submits the save to the background thread."""
+        weights = self.model.get_weights()
+        running = [future for future in self._pending if not future.done()]
+        if len(running) >= self._max_pending_saves:
+            concurrent.futures.wait(running[:1])
+        # Raise errors of finished saves right away instead of hiding them until the end of training
+        for future in self._pending:
+            if future.done():
+                future.result()
+        self._pending = [future for future in self._pending if not future.done()]
+        self._pending.append(self._io_pool.submit(self._save_checkpoint, weights, checkpoint_dir, export))
+    
+    def _save_checkpoint(self, weights, checkpoint_dir, export):
+        with self._io_lock:
+            self._export_model.set_weights(weights)
+            if export:
+                self._export_saved_model(checkpoint_dir)
+            else:
+                self._checkpoint_manager.save()
+            if self.save_eval_plot:
+                self._save_evaluation_plot(self._export_model, checkpoint_dir, self.validation_dataset)
+    
+    def _export_best_checkpoint(self, checkpoint_dir):
+        with self._io_lock:
+            self._checkpoint.restore(self._checkpoint_manager.latest_checkpoint)
+            self._export_saved_model(checkpoint_dir)
+    
+    def _export_saved_model(self, checkpoint_dir):
+        """Exports the export model as SavedModel to checkpoint_dir.
+
+        For GCS the model is written to a local staging directory first and then uploaded.
+        """
+        if not self._stage_locally:
+            tf.keras.models.save_model(self._export_model, checkpoint_dir, save_format='tf')
+            return
+        
+        staging_root = cst.STAGING_DIR if os.path.isdir(cst.STAGING_DIR) else None
+        staging_dir = tempfile.mkdtemp(prefix="checkpoint_", dir=staging_root)
+        export_dir = os.path.join(staging_dir, "saved_model")
+        try:
+            tf.keras.models.save_model(self._export_model, export_dir, save_format='tf')
+            uploads = _upload_directory(export_dir, checkpoint_dir, self._upload_pool)
+            for upload in concurrent.futures.as_completed(uploads):
+                upload.result()
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
         
     def _save_evaluation_plot(self, model, checkpoint_dir, dataset, file_name='validation_plot.html'):
         html_dir = os.path.join(checkpoint_dir, file_name)
         
         if self.cloud_run:
-            scaling_factors = dp.load_scaling_factors(gcloud_bucket=self.bucket)
+            bucket = ev.get_bucket()
+            scaling_factors = dp.load_scaling_factors(gcloud_bucket=bucket)
         else:
             scaling_factors = dp.load_scaling_factors()
             
         # Make a forward pass over the whole validation dataset and get the results as a dataframe
-        val_results = ev.get_predictions_results(model, dataset, scaling_factors)
+        val_results = ev.get_predictions_results(model, dataset, scaling_factors, predict_fn=self._predict_fn)
         
-        # Plot the resutls with plotly and wrap the resulting <div> as a html string
-        plot_div = ev.plot_predictions_and_errors(val_results)
-        plot_html = "<html><body>{}</body></html>".format(plot_div)
-        
-        # Save the html either in google cloud or locally
-        if self.cloud_run:
-            # Splitting path and only taking the tail, because self.bucket already knows about the bucket location
-            blob = self.bucket.blob(html_dir.split(cst.BUCKET_NAME + "/")[-1])
-            blob.upload_from_string(plot_html, content_type="text/html")
-        else:
-            with open(html_dir, 'w') as f:
-                f.write(plot_html)
\ No newline at end of file
+        # Plotting and saving happens in the plot process
+        self._plot_queue.put((val_results, html_dir))
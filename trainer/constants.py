@@ -27,8 +27,10 @@ SECONDARY_TEST_SET = join(DATASETS_DIR, 'secondary_test', '*tfrecord')  # regexp
 BIG_TRAIN_SET = join(DATASETS_DIR, 'train_big', '*tfrecord')  	 # regexp for the combined training set (train + 1st test sets)
 SCALING_FACTORS_DIR = join(DATASETS_DIR, 'scaling_factors.csv')  # location for scaling factors for tfrecords files
 DATA_DIR = 'data'
+RECORD_COUNTS_FILE_NAME = 'record_counts.json'  # cache for number of records per tfrecord file, next to the data
 
 BUCKET_NAME = 'ion_age_bucket'
+STAGING_DIR = '/dev/shm'  # local (tmpfs) directory for staging checkpoints before uploading them to GCS
 
 # Hyperparameter names
 CONV_KERNEL = 'conv_kernel'
@@ -1,13 +1,22 @@
+import collections
 import csv
+import json
+import math
 import pickle
 import os
 
+import numpy as np
 import tensorflow as tf
 from tensorflow.train import FloatList, Feature, Features, Example
 
 import trainer.constants as cst
 
 
+# Immutable window and batch parameters shared by all datasets of a training run. The values are plain
+# python ints, so they end up as constants in the tf.data graph.
+DatasetConfig = collections.namedtuple('DatasetConfig', ['window_size', 'shift', 'stride', 'batch_size'])
+
+
 def get_cycle_example(cell_value, summary_idx, cycle_idx, scaling_factors):
     """
     Define the columns that should be written to tfrecords and converts the raw data
@@ -165,7 +174,7 @@ def get_flatten_windows(window_size):
     return flatten_windows
 
 
-def get_create_cell_dataset_from_tfrecords(window_size, shift, stride, drop_remainder):
+def get_create_cell_dataset_from_tfrecords(window_size, shift, stride, drop_remainder, num_parallel_calls=None):
     def create_cell_dataset_from_tfrecords(file):
         """
         The read_tfrecords() function reads a file, skipping the first row which in our case
@@ -175,7 +184,7 @@ def get_create_cell_dataset_from_tfrecords(window_size, shift, stride, drop_rema
         that we batch before shuffling, so the examples within the batches stay in order.
         """
         dataset = tf.data.TFRecordDataset(file)
-        dataset = dataset.map(parse_features)
+        dataset = dataset.map(parse_features, num_parallel_calls=num_parallel_calls)  # map() preserves the order
         dataset = dataset.window(size=window_size, shift=shift, stride=stride, drop_remainder=drop_remainder)
         dataset = dataset.flat_map(get_flatten_windows(window_size))
         return dataset
@@ -185,7 +194,7 @@ def get_create_cell_dataset_from_tfrecords(window_size, shift, stride, drop_rema
 def create_dataset(data_dir, window_size, shift, stride, batch_size, 
                    cycle_length=4, num_parallel_calls=4,
                    drop_remainder=True, shuffle=True,
-                   shuffle_buffer=500, repeat=True):
+                   shuffle_buffer=500, repeat=True, cache=False, snapshot_dir=None):
     """
     Creates a dataset from .tfrecord files in the data directory. Expects a regular expression
     to capture multiple files (e.g. "data/tfrecords/train/*tfrecord").
@@ -200,23 +209,136 @@ def create_dataset(data_dir, window_size, shift, stride, batch_size,
     are out of items. Then it gets the next 4 file paths from the filepath_dataset and
     interleaves them the same way, and so on until it runs out of file paths.
     Even with parallel calls specified, data within batches is sequential.
+    The num_parallel_calls are also used for parsing the records of every file. Pass
+    tf.data.experimental.AUTOTUNE for cycle_length and num_parallel_calls to let the
+    tf.data runtime pick the parallelism based on the available CPU cores.
+
+    Notes about caching:
+    Set "cache" to True to keep the parsed windows in memory after the first epoch, or pass
+    a filename to cache them on disk if they don't fit into memory. The cache is placed after
+    listing and interleaving the files, so the file order of the first epoch is replayed in every
+    later epoch and only the shuffle buffer still mixes the windows differently. Without a cache,
+    every epoch draws a new file order.
+    The cache holds the windows, not the records, so every record is stored about
+    window_size / shift times (e.g. 4x for window_size=20 and shift=5, 20x for window_size=100
+    and shift=5). A single window with window_size=20 already holds 2 * 20 * 1000 floats (~160 KB).
+    Pass a "snapshot_dir" (local or GCS) to persist the parsed windows across runs (TensorFlow 2.3+).
+    The snapshot is only reused if the pipeline up to this point (files and window parameters) is unchanged.
     """
     filepath_dataset = tf.data.Dataset.list_files(data_dir)
     assembled_dataset = filepath_dataset.interleave(get_create_cell_dataset_from_tfrecords(window_size, shift, stride,
-                                                                                           drop_remainder),
+                                                                                           drop_remainder,
+                                                                                           num_parallel_calls),
                                                     cycle_length=cycle_length,
                                                     num_parallel_calls=num_parallel_calls)
-    if shuffle:
-        assembled_dataset = assembled_dataset.shuffle(shuffle_buffer)
+    if snapshot_dir:
+        if not hasattr(tf.data.experimental, 'snapshot'):
+            raise ValueError("snapshot_dir requires TensorFlow 2.3 or later, found {}".format(tf.__version__))
+        assembled_dataset = assembled_dataset.apply(tf.data.experimental.snapshot(snapshot_dir, compression='AUTO'))
+    
+    if cache:
+        assembled_dataset = assembled_dataset.cache(cache if isinstance(cache, str) else '')
+    
+    if shuffle and repeat:
+        # Shuffling directly followed by repeating is fused into a single transformation by
+        # tf.data, so the shuffle buffer is not refilled from scratch at every epoch boundary
+        assembled_dataset = assembled_dataset.shuffle(shuffle_buffer, reshuffle_each_iteration=True).repeat()
+    elif shuffle:
+        assembled_dataset = assembled_dataset.shuffle(shuffle_buffer, reshuffle_each_iteration=True)
     
     # The batching has to happen after shuffling the windows, so one batch is not sequential
     assembled_dataset = assembled_dataset.batch(batch_size)
     
-    if repeat:
+    if repeat and not shuffle:
         assembled_dataset = assembled_dataset.repeat()
+    
+    # Prepare the next batches while the current one is processed by the model
+    assembled_dataset = assembled_dataset.prefetch(tf.data.experimental.AUTOTUNE)
     return assembled_dataset
 
 
+def create_plot_dataset(data_dir, window_size, shift, stride, batch_size, num_samples=None):
+    """
+    Creates a deterministic dataset for plotting predictions. The files are read one after another
+    in sorted order and the windows of every cell stay in order, so the results can be plotted per cell.
+
+    If num_samples is given, about num_samples windows are selected evenly over all cells: every
+    cell contributes the same number of windows, spread over its whole lifetime (every n-th window).
+    """
+    windows_per_file = count_windows(data_dir, window_size, shift, stride)
+    files = sorted(windows_per_file)
+    if num_samples is None:
+        samples_per_file = max(1, max(windows_per_file.values()))
+    else:
+        samples_per_file = max(1, int(math.ceil(num_samples / len(files))))
+    steps = [max(1, windows_per_file[file] // samples_per_file) for file in files]
+    
+    create_cell_dataset = get_create_cell_dataset_from_tfrecords(window_size, shift, stride,
+                                                                 drop_remainder=True, num_parallel_calls=1)
+    
+    def sample_cell_dataset(file, step):
+        return create_cell_dataset(file).shard(step, 0).take(samples_per_file)
+    
+    dataset = tf.data.Dataset.from_tensor_slices((files, tf.constant(steps, dtype=tf.int64)))
+    dataset = dataset.flat_map(sample_cell_dataset)
+    return dataset.batch(batch_size)
+
+
+def count_windows(data_dir, window_size, shift, stride):
+    """Returns a dict with the number of windows that create_dataset() creates from every file."""
+    # Number of records covered by a single window
+    window_span = (window_size - 1) * stride + 1
+    return {file: max(0, (n_records - window_span) // shift + 1)
+            for file, n_records in count_records(data_dir).items()}
+
+
+def count_records(data_dir, counts_file_name=cst.RECORD_COUNTS_FILE_NAME):
+    """
+    Returns a dict with the number of records (= charging cycles) for every .tfrecord file
+    that matches the regular expression in data_dir.
+
+    Counting requires reading every file once, so the result is cached as a json file
+    next to the data ({file: {"records": n_records, "length": bytes, "mtime_nsec": mtime}}).
+    On subsequent calls only files that are missing from the cache or whose size or
+    modification time changed (e.g. rewritten tfrecords) are read.
+    """
+    files = sorted(tf.io.gfile.glob(data_dir))
+    counts_path = os.path.join(os.path.dirname(data_dir), counts_file_name)
+    
+    cached_counts = dict()
+    if tf.io.gfile.exists(counts_path):
+        try:
+            with tf.io.gfile.GFile(counts_path, 'r') as f:
+                cached_counts = json.load(f)
+        except ValueError:
+            # E.g. a truncated file from an interrupted write, all files are counted again
+            print("Could not read record counts from {}, recounting".format(counts_path))
+    
+    counts = dict()
+    changed = False
+    for file in files:
+        file_stat = tf.io.gfile.stat(file)
+        entry = cached_counts.get(file)
+        if (not isinstance(entry, dict)
+                or entry.get("length") != file_stat.length
+                or entry.get("mtime_nsec") != file_stat.mtime_nsec):
+            # Count inside the tf.data runtime instead of iterating the records in python
+            n_records = int(tf.data.TFRecordDataset(file).reduce(np.int64(0), lambda count, _: count + 1))
+            entry = {"records": n_records, "length": file_stat.length, "mtime_nsec": file_stat.mtime_nsec}
+            cached_counts[file] = entry
+            changed = True
+        counts[file] = entry["records"]
+    
+    if changed:
+        try:
+            with tf.io.gfile.GFile(counts_path, 'w') as f:
+                json.dump(cached_counts, f)
+        except tf.errors.OpError:
+            # The cache is only an optimization, read-only data locations are fine
+            print("Could not write record counts to {}".format(counts_path))
+    return counts
+
+
 def calculate_and_save_scaling_factors(data_dict, train_test_split, csv_dir):
     """Calculates the scaling factors for every feature based on the training set in train_test_split
     and saves the result in a csv file. The factors are used during writing of the tfrecords files."""
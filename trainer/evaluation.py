@@ -1,3 +1,6 @@
+import functools
+import os
+
 from plotly import tools
 import plotly.offline as pyo
 import plotly.graph_objs as go
@@ -9,22 +12,68 @@ from trainer import constants as cst
 # TODO Feature values
 
 
-def get_predictions_results(model, dataset, scaling_factors_dict):
+@functools.lru_cache(maxsize=None)
+def get_bucket(bucket_name=cst.BUCKET_NAME):
+    """Creates the storage client on first use and shares it within the process."""
+    # Imported here, so local runs don't pay for importing the GCS client
+    from google.cloud import storage
+    return storage.Client().get_bucket(bucket_name)
+
+
+def plot_worker(plot_queue, cloud_run):
+    """Renders and saves validation plots in a separate process until None is received.
+
+    Plotly builds the html in pure python, so it runs in its own process to not compete
+    with training for the GIL. Note that a spawned process re-imports the main module of
+    the parent (e.g. trainer.task), so the child still imports TensorFlow once at startup.
+    """
+    for val_results, html_dir in iter(plot_queue.get, None):
+        # Plot the resutls with plotly and wrap the resulting <div> as a html string
+        # Load plotly.js from the CDN instead of embedding it in every checkpoint's html
+        plot_div = plot_predictions_and_errors(val_results, include_plotlyjs='cdn')
+        plot_html = "<html><body>{}</body></html>".format(plot_div)
+        
+        # Save the html either in google cloud or locally
+        if cloud_run:
+            # Splitting path and only taking the tail, because the bucket already knows about its location
+            blob = get_bucket().blob(html_dir.split(cst.BUCKET_NAME + "/")[-1])
+            blob.upload_from_string(plot_html, content_type="text/html")
+        else:
+            os.makedirs(os.path.dirname(html_dir), exist_ok=True)
+            with open(html_dir, 'w') as f:
+                f.write(plot_html)
+
+
+def get_predictions_results(model, dataset, scaling_factors_dict, predict_fn=None):
+    """Makes predictions for the whole dataset and returns them together with the targets as a dataframe.
 
-    predictions = []
-    targets = []
+    The data is read from the source only once. Datasets from create_dataset() list their files in a
+    new random order on every iteration, so predictions and targets could otherwise belong to different cells.
     
-    for i, (example, target) in enumerate(dataset):
-        predictions.extend(model.predict(example).tolist())
-        targets.extend(target.numpy().tolist())
+    If a precompiled predict_fn is passed (e.g. a tf.function with an input_signature), it is called
+    once per batch instead of model.predict().
+    """
+    if predict_fn is None:
+        # The targets are read in a second pass, the cache replays exactly the data that was predicted on
+        dataset = dataset.cache()
+        # A single predict() call runs the forward pass over all batches without python overhead per batch
+        predictions = model.predict(dataset)
+        targets = np.concatenate([target.numpy() for _, target in dataset])
+    else:
+        # Every batch is a single call of the traced function, which runs on the accelerator.
+        # Mapping it over the dataset would move the forward pass to the tf.data threads on the CPU.
+        predictions = []
+        targets = []
+        for example, target in dataset:
+            predictions.append(predict_fn(example).numpy())
+            targets.append(target.numpy())
+        predictions = np.concatenate(predictions)
+        targets = np.concatenate(targets)
     
     if scaling_factors_dict:
         # Scale to original range and round for floating point errors of conversion.
         predictions = np.round(np.array(predictions) * scaling_factors_dict[cst.REMAINING_CYCLES_NAME]).astype(np.int)
         targets = np.round(np.array(targets) * scaling_factors_dict[cst.REMAINING_CYCLES_NAME]).astype(np.int)
-    else:
-        predictions = np.array(predictions)
-        targets = np.array(targets)
         
     results_df = pd.DataFrame({
         "pred_current_cycle": predictions[:, 0],
@@ -63,12 +112,15 @@ def create_cell_index(results_df, cell_index_col_name="cell_index", inplace=Fals
         return results
 
 
-def plot_predictions_and_errors(results_df, height=1300, width=4000, return_div=True):
+def plot_predictions_and_errors(results_df, height=1300, width=4000, return_div=True, include_plotlyjs=True):
     """Plots predictions vs. target and the corresponding absolute errors
     for current and remaining cycles.
     
     if return_div == False, a normal plotly plot is created and opended in a new tab.
     Otherwise the returned <div> element may be used for wrapping the plot in html. 
+    
+    include_plotlyjs is passed to plotly: True embeds the whole plotly.js bundle (~3MB) in the
+    <div>, 'cdn' only adds a script tag that loads it from the plotly CDN.
     """
     
     x_values = np.arange(len(results_df))
@@ -143,7 +195,7 @@ def plot_predictions_and_errors(results_df, height=1300, width=4000, return_div=
     )
     
     if return_div:
-        div = pyo.plot(fig, output_type='div')
+        div = pyo.plot(fig, output_type='div', include_plotlyjs=include_plotlyjs)
         return div
     else:
         pyo.plot(fig)
@@ -109,7 +109,8 @@ def create_keras_model(window_size, loss, hparams_config=None):
     # update keras context with custom activation object
     get_custom_objects().update({'clippy': Clippy(clipped_relu)})
     
-    main_output = Dense(2, name='output', activation='clippy')(dropout_output)
+    # float32 output keeps the loss numerically stable when training with a mixed precision policy
+    main_output = Dense(2, name='output', activation='clippy', dtype='float32')(dropout_output)
 
     # # Splitting neurons into two parts for the two outputs
     # split_cc, split_rc = tf.split(hidden_dense2, num_or_size_splits=2, axis=-1)
@@ -90,7 +90,8 @@ def create_keras_model(window_size, loss, hparams_config=None):
     get_custom_objects().update({'clippy': Clippy(clipped_relu)})
 
     # use (adapted) Relu activation on the last layer for striclty positive outputs
-    main_output = Dense(2, name='output', activation='clippy')(hidden_dense)
+    # float32 output keeps the loss numerically stable when training with a mixed precision policy
+    main_output = Dense(2, name='output', activation='clippy', dtype='float32')(hidden_dense)
 
     model = Model(inputs=[qdlin_in, tdlin_in, ir_in, dt_in, qd_in], outputs=[main_output])
     
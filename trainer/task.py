@@ -1,5 +1,7 @@
 import argparse
+import concurrent.futures
 import datetime
+import math
 import os
 
 import tensorflow as tf
@@ -10,6 +12,16 @@ import trainer.data_pipeline as dp
 import trainer.split_model as split_model
 import trainer.full_cnn_model as full_cnn_model
 from trainer.callbacks import CustomCheckpoints
+from trainer.custom_metrics_losses import mae_current_cycle, mae_remaining_cycles
+
+
+def str_to_bool(value):
+    """Parses boolean command line values, since type=bool treats every non-empty string as True."""
+    if value.lower() in ('true', 'yes', '1'):
+        return True
+    if value.lower() in ('false', 'no', '0'):
+        return False
+    raise argparse.ArgumentTypeError("Boolean value expected, got {}".format(value))
 
 
 def get_args():
@@ -79,7 +91,7 @@ def get_args():
     parser.add_argument(
         '--shuffle',
         default=True,
-        type=bool,
+        type=str_to_bool,
         help='shuffle the batched dataset, default=True'
     )
     parser.add_argument(
@@ -94,6 +106,37 @@ def get_args():
         type=int,
         help='epoch after which model checkpoints are saved, default=80'
     )
+    parser.add_argument(
+        '--mixed-precision',
+        choices=['mixed_float16', 'mixed_bfloat16'],
+        help='Keras mixed precision policy, mixed_float16 for GPUs, mixed_bfloat16 for TPUs. Disabled by default'
+    )
+    parser.add_argument(
+        '--cache',
+        default='none',
+        type=str,
+        help='cache for the parsed windows: "memory", "none" or a local/GCS directory for cache files. '
+             'Every record is stored about window_size/shift times. The file order of the first epoch '
+             'is reused in all later epochs, only the shuffle buffer still varies. Default=none'
+    )
+    parser.add_argument(
+        '--snapshot-dir',
+        type=str,
+        help='local or GCS location for persisting the parsed datasets across runs, requires TensorFlow 2.3+, '
+             'disabled by default'
+    )
+    parser.add_argument(
+        '--save-eval-plot',
+        default=False,
+        type=str_to_bool,
+        help='save a html plot of the validation predictions with every checkpoint, default=False'
+    )
+    parser.add_argument(
+        '--plot-samples',
+        default=512,
+        type=int,
+        help='number of validation samples shown in the evaluation plot of every checkpoint, default=512'
+    )
     parser.add_argument(
         '--model',
         default='split_model',
@@ -115,43 +158,65 @@ def train_and_evaluate(args, tboard_dir, hparams=None):
     args: dictionary of arguments - see get_args() for details
     """
     # Config datasets for consistent usage
-    ds_config = dict(window_size=args.window_size,
-                     shift=args.shift,
-                     stride=args.stride,
-                     batch_size=args.batch_size)
+    ds_config = dp.DatasetConfig(window_size=args.window_size,
+                                 shift=args.shift,
+                                 stride=args.stride,
+                                 batch_size=args.batch_size)
     ds_train_path = args.data_dir_train
     ds_val_path = args.data_dir_validate
 
+    # Computations in half precision, variables and the output layer stay in float32
+    if args.mixed_precision:
+        if hasattr(tf.keras.mixed_precision, 'set_global_policy'):
+            tf.keras.mixed_precision.set_global_policy(args.mixed_precision)
+        else:
+            # TensorFlow < 2.4 only has the experimental API
+            tf.keras.mixed_precision.experimental.set_policy(args.mixed_precision)
+    
     # create model
     if args.model == 'split_model':
         print("Using split model!")
-        model = split_model.create_keras_model(window_size=ds_config["window_size"],
+        model = split_model.create_keras_model(window_size=ds_config.window_size,
                                                loss=args.loss,
                                                hparams_config=hparams)
     if args.model == 'full_cnn_model':
         print("Using full cnn model!")
-        model = full_cnn_model.create_keras_model(window_size=ds_config["window_size"],
+        model = full_cnn_model.create_keras_model(window_size=ds_config.window_size,
                                                   loss=args.loss,
                                                   hparams_config=hparams)
     
-    # Calculate steps_per_epoch_train, steps_per_epoch_test
-    # This is needed, since for counting repeat has to be false
-    steps_per_epoch_train = calculate_steps_per_epoch(data_dir=ds_train_path, dataset_config=ds_config)
-    
-    steps_per_epoch_validate = calculate_steps_per_epoch(data_dir=ds_val_path, dataset_config=ds_config)
-    
     # load datasets
     dataset_train = dp.create_dataset(data_dir=ds_train_path,
-                                      window_size=ds_config["window_size"],
-                                      shift=ds_config["shift"],
-                                      stride=ds_config["stride"],
-                                      batch_size=ds_config["batch_size"])
+                                      window_size=ds_config.window_size,
+                                      shift=ds_config.shift,
+                                      stride=ds_config.stride,
+                                      batch_size=ds_config.batch_size,
+                                      cycle_length=tf.data.experimental.AUTOTUNE,
+                                      num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                                      shuffle=args.shuffle,
+                                      shuffle_buffer=args.shuffle_buffer,
+                                      cache=get_cache(args, "train"),
+                                      snapshot_dir=get_snapshot_dir(args, "train"))
     
     dataset_validate = dp.create_dataset(data_dir=ds_val_path,
-                                         window_size=ds_config["window_size"],
-                                         shift=ds_config["shift"],
-                                         stride=ds_config["stride"],
-                                         batch_size=ds_config["batch_size"])
+                                         window_size=ds_config.window_size,
+                                         shift=ds_config.shift,
+                                         stride=ds_config.stride,
+                                         batch_size=ds_config.batch_size,
+                                         cycle_length=tf.data.experimental.AUTOTUNE,
+                                         num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                                         shuffle=False,  # Repeat after batching, so every validation is one exact pass
+                                         cache=get_cache(args, "validate"),
+                                         snapshot_dir=get_snapshot_dir(args, "validate"))
+    
+    # Calculate steps_per_epoch_train, steps_per_epoch_test
+    # This is needed, since the datasets are repeated indefinitely
+    # Both sets are counted in parallel, since counting uncached files has to read them completely
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+        steps_train_future = pool.submit(calculate_steps_per_epoch, data_dir=ds_train_path, dataset_config=ds_config)
+        steps_validate_future = pool.submit(calculate_steps_per_epoch, data_dir=ds_val_path, dataset_config=ds_config)
+        steps_per_epoch_train = steps_train_future.result()
+        steps_per_epoch_validate = steps_validate_future.result()
     
     # if hparams is passed, we're running a HPO-job
     if hparams:
@@ -159,14 +224,18 @@ def train_and_evaluate(args, tboard_dir, hparams=None):
                                                 log_dir=tboard_dir,
                                                 dataset_path=ds_val_path,
                                                 dataset_config=ds_config,
-                                                save_eval_plot=False)
+                                                metrics=[mae_current_cycle, mae_remaining_cycles],
+                                                save_eval_plot=args.save_eval_plot,
+                                                plot_samples=args.plot_samples)
     else:
         checkpoint_callback = CustomCheckpoints(save_best_only=True,
                                                 start_epoch=args.save_from,
                                                 log_dir=tboard_dir,
                                                 dataset_path=ds_val_path,
                                                 dataset_config=ds_config,
-                                                save_eval_plot=False)
+                                                metrics=[mae_current_cycle, mae_remaining_cycles],
+                                                save_eval_plot=args.save_eval_plot,
+                                                plot_samples=args.plot_samples)
     callbacks = [
         tf.keras.callbacks.TensorBoard(log_dir=tboard_dir,
                                        histogram_freq=0,
@@ -193,16 +262,34 @@ def train_and_evaluate(args, tboard_dir, hparams=None):
 
 
 def calculate_steps_per_epoch(data_dir, dataset_config):
-    temp_dataset = dp.create_dataset(data_dir=data_dir,
-                                     window_size=dataset_config["window_size"],
-                                     shift=dataset_config["shift"],
-                                     stride=dataset_config["stride"],
-                                     batch_size=dataset_config["batch_size"],
-                                     repeat=False)
-    steps_per_epoch = 0
-    for batch in temp_dataset:
-        steps_per_epoch += 1
-    return steps_per_epoch
+    """Calculates the number of batches in one pass over the dataset without iterating it.
+
+    Windows are created per file (= cell), so the number of windows is derived from the
+    number of records in every file and the window parameters in dataset_config.
+    """
+    n_windows = sum(dp.count_windows(data_dir,
+                                     window_size=dataset_config.window_size,
+                                     shift=dataset_config.shift,
+                                     stride=dataset_config.stride).values())
+    
+    # The last batch is not dropped, so it counts as one step
+    return int(math.ceil(n_windows / dataset_config.batch_size))
+
+
+def get_cache(args, split_name):
+    """Translates the --cache argument into the cache argument of dp.create_dataset()."""
+    if args.cache == 'memory':
+        return True
+    if args.cache == 'none':
+        return False
+    tf.io.gfile.makedirs(args.cache)
+    return os.path.join(args.cache, split_name)
+
+
+def get_snapshot_dir(args, split_name):
+    if args.snapshot_dir is None:
+        return None
+    return os.path.join(args.snapshot_dir, split_name)
 
 
 def get_tboard_dir():